@@ -1,7 +1,10 @@
 import logging
 import ffmpeg
 import os
-import uuid
+import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import cv2
 import numpy as np
 import mediapipe as mp
@@ -11,21 +14,71 @@ from mediapipe.tasks.python import vision
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Make sure OpenCV's SIMD/IPP-optimized kernels (cvtColor, resize, blur, blend) are enabled
+cv2.setUseOptimized(True)
+logger.info(f"OpenCV optimized code paths enabled: {cv2.useOptimized()}")
+
 # Get the directory where this file is located
 current_dir = os.path.dirname(os.path.abspath(__file__))
 
 face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
 
 # YuNet face detection model
+# Detection cost scales with pixel count, so frames are downscaled by YUNET_DOWNSCALE before detection,
+# and further only if that would still exceed YUNET_MAX_INPUT_SIZE (width, height). Faces shrink by the
+# same factor, so very large uploads (beyond ~2x the cap) lose the smallest faces to YuNet's ~10px floor
+YUNET_DOWNSCALE = 0.5
+YUNET_MAX_INPUT_SIZE = (960, 720)
+# Detector size used for the warm-up call; each thread re-sizes its detector only when the frame size changes
+YUNET_WARMUP_SIZE = (320, 240)
 yunet_model_path = os.path.join(current_dir, "models", "face_detection_yunet_2023mar.onnx")
-yunet = cv2.FaceDetectorYN.create(
-    model=yunet_model_path,
-    config="",
-    input_size=(640, 640),
-    score_threshold=0.9,
-    nms_threshold=0.3,
-    top_k=5000
-)
+
+
+def create_yunet(backend_id, target_id):
+    detector = cv2.FaceDetectorYN.create(
+        model=yunet_model_path,
+        config="",
+        input_size=YUNET_WARMUP_SIZE,
+        score_threshold=0.9,
+        nms_threshold=0.3,
+        top_k=5000,
+        backend_id=backend_id,
+        target_id=target_id
+    )
+    # Warm up with a blank frame so the first request doesn't pay for graph/kernel initialization
+    detector.detect(np.zeros((YUNET_WARMUP_SIZE[1], YUNET_WARMUP_SIZE[0], 3), dtype=np.uint8))
+    return detector
+
+
+# FaceDetectorYN instances are not safe to call concurrently, so each thread gets its own
+_yunet_local = threading.local()
+
+# Prefer the CUDA backend (FP16) when OpenCV was built with CUDA and a device is present.
+# The backend is chosen once here; per-thread detectors are then created with the same one
+yunet_backend = (cv2.dnn.DNN_BACKEND_DEFAULT, cv2.dnn.DNN_TARGET_CPU)
+if cv2.cuda.getCudaEnabledDeviceCount() > 0:
+    try:
+        create_yunet(cv2.dnn.DNN_BACKEND_CUDA, cv2.dnn.DNN_TARGET_CUDA_FP16)
+        yunet_backend = (cv2.dnn.DNN_BACKEND_CUDA, cv2.dnn.DNN_TARGET_CUDA_FP16)
+        logger.info("YuNet using CUDA FP16 backend")
+    except cv2.error as e:
+        logger.info(f"CUDA backend unavailable ({e}), falling back to CPU YuNet")
+
+
+def get_yunet():
+    """
+    Return this thread's YuNet detector, creating (and warming up) one on first use.
+    """
+    detector = getattr(_yunet_local, "detector", None)
+    if detector is None:
+        detector = create_yunet(*yunet_backend)
+        _yunet_local.detector = detector
+        _yunet_local.input_size = YUNET_WARMUP_SIZE
+    return detector
+
+
+# Build one detector at import so a broken model fails at startup rather than on the first request
+get_yunet()
 
 segmenter_model_path = os.path.join(current_dir, "models", "selfie_segmenter.tflite")
 if not os.path.exists(segmenter_model_path):
@@ -34,47 +87,193 @@ if not os.path.exists(segmenter_model_path):
     model_url = "https://storage.googleapis.com/mediapipe-models/image_segmenter/selfie_segmenter/float16/latest/selfie_segmenter.tflite"
     urllib.request.urlretrieve(model_url, segmenter_model_path)
 
-# segmenter options initialization
-base_options = python.BaseOptions(model_asset_path=segmenter_model_path)
-options = vision.ImageSegmenterOptions(
-    base_options=base_options,
-    output_category_mask=True
-)
-segmenter = vision.ImageSegmenter.create_from_options(options)
+def create_segmenter(delegate):
+    # segmenter options initialization
+    base_options = python.BaseOptions(model_asset_path=segmenter_model_path, delegate=delegate)
+    options = vision.ImageSegmenterOptions(
+        base_options=base_options,
+        output_category_mask=True
+    )
+    return vision.ImageSegmenter.create_from_options(options)
+
+
+def time_segmenter(candidate):
+    """
+    Run a blank frame through the segmenter, including the category mask readback,
+    and return the seconds taken by the fastest of a few warm calls. Raises if the
+    graph fails at inference time rather than at creation time.
+    """
+    blank = mp.Image(image_format=mp.ImageFormat.SRGB, data=np.zeros((480, 640, 3), dtype=np.uint8))
+    # First call initializes the graph (and GPU context), so it is not timed
+    candidate.segment(blank).category_mask.numpy_view()
+    timings = []
+    for _ in range(3):
+        start = time.perf_counter()
+        candidate.segment(blank).category_mask.numpy_view()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+# Prefer the GPU delegate; MediaPipe silently defaults to XNNPACK on CPU otherwise.
+# Creation alone proves little: the GPU graph can still fail on the first segment(), or come up
+# on a software rasterizer (e.g. llvmpipe) that is slower than XNNPACK. Test both and keep the faster
+segmenter = create_segmenter(python.BaseOptions.Delegate.CPU)
+cpu_seconds = time_segmenter(segmenter)
+try:
+    gpu_segmenter = create_segmenter(python.BaseOptions.Delegate.GPU)
+    try:
+        gpu_seconds = time_segmenter(gpu_segmenter)
+    except Exception:
+        gpu_segmenter.close()
+        raise
+    if gpu_seconds < cpu_seconds:
+        segmenter.close()
+        segmenter = gpu_segmenter
+        logger.info(f"Selfie segmenter using GPU delegate ({gpu_seconds * 1000:.1f} ms vs {cpu_seconds * 1000:.1f} ms on CPU)")
+    else:
+        gpu_segmenter.close()
+        logger.info(f"GPU delegate slower than CPU ({gpu_seconds * 1000:.1f} ms vs {cpu_seconds * 1000:.1f} ms), using CPU segmenter")
+except Exception as e:
+    logger.info(f"GPU delegate unavailable ({e}), using CPU segmenter")
+
+# Worker threads for running YuNet alongside segmentation; both release the GIL in native code.
+# Each worker has its own detector (see get_yunet), so two requests' detections can run at once
+detection_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="yunet")
+
+# The segmenter is a single instance shared by all request threads and is not safe to call
+# concurrently, so segmentation is serialized; it still overlaps with face detection
+segmenter_lock = threading.Lock()
+
+# Per-thread scratch arrays reused across frames of the same size
+_scratch_buffers = threading.local()
+
+
+def _scratch(name, shape, dtype=np.uint8):
+    """
+    Return this thread's reusable buffer called `name`, (re)allocating it only when
+    the requested shape or dtype changes. Contents are overwritten by the next caller.
+    """
+    buf = getattr(_scratch_buffers, name, None)
+    if buf is None or buf.shape != shape or buf.dtype != dtype:
+        buf = np.empty(shape, dtype=dtype)
+        setattr(_scratch_buffers, name, buf)
+    return buf
+
+
+def to_grayscale(image_np):
+    """
+    Convert a BGR image to single-channel grayscale into this thread's scratch buffer.
+    """
+    return cv2.cvtColor(image_np, cv2.COLOR_BGR2GRAY, dst=_scratch("gray", image_np.shape[:2]))
+
+
+# Temp directory is resolved once and created on first use; names are unique per process via pid + counter
+temp_dir = os.path.join(current_dir, "temp")
+_temp_dir_created = False
+_temp_counter = itertools.count()
+_pid = os.getpid()
+
 
 def get_temp_path():
-    temp_dir = os.path.join(os.path.dirname(__file__), "temp")
-    os.makedirs(temp_dir, exist_ok=True)
-    random_filename = f"temp_{str(uuid.uuid4())[:8]}"
-    return os.path.join(temp_dir, random_filename)
+    global _temp_dir_created
+    if not _temp_dir_created:
+        os.makedirs(temp_dir, exist_ok=True)
+        _temp_dir_created = True
+    return os.path.join(temp_dir, f"temp_{_pid}_{next(_temp_counter):08x}")
 
 
-def detect_faces(image_np):
+def decode_image(data):
+    """
+    Decode encoded image bytes (JPEG, PNG, ...) into a BGR numpy array.
+
+    Args:
+        data: Raw bytes of the uploaded image file
+
+    Returns:
+        image_np: Decoded image as numpy array (H, W, 3) in BGR format, or None if undecodable
+    """
+    buf = np.frombuffer(data, dtype=np.uint8)
+    if buf.size == 0:
+        return None
+    return cv2.imdecode(buf, cv2.IMREAD_COLOR)
+
+
+def _run_yunet(image_np):
+    """
+    Run YuNet on a downscaled copy of the frame and map results back.
+
+    Args:
+        image_np: Color image as numpy array (H, W, 3) in BGR format
+
+    Returns:
+        faces: YuNet output rows with box and landmark coordinates in the
+            original image's pixel space, or None if no faces were found
+    """
     h, w, _ = image_np.shape
-    yunet.setInputSize((w, h))
+    max_w, max_h = YUNET_MAX_INPUT_SIZE
+
+    # Relative downscale, capped so huge uploads don't run the detector at full cost
+    scale = min(YUNET_DOWNSCALE, max_w / w, max_h / h)
+    new_w = max(1, int(round(w * scale)))
+    new_h = max(1, int(round(h * scale)))
+    # INTER_AREA avoids aliasing when shrinking, which keeps small faces detectable
+    resized = cv2.resize(image_np, (new_w, new_h), interpolation=cv2.INTER_AREA)
+
+    detector = get_yunet()
+    # Reshaping the detector is only needed when the frame size changes, not per request
+    if _yunet_local.input_size != (new_w, new_h):
+        detector.setInputSize((new_w, new_h))
+        _yunet_local.input_size = (new_w, new_h)
 
-    _, faces = yunet.detect(image_np)
+    _, faces = detector.detect(resized)
 
-    results = []
+    if faces is None:
+        return None
+
+    # Columns 0-13 are the box and the five landmark points, all in pixels, alternating x/y
+    faces[:, 0:14:2] *= w / new_w
+    faces[:, 1:14:2] *= h / new_h
+    return faces
+
+
+def _face_detections(faces, w, h):
+    """
+    Convert YuNet output rows into normalized face detection dicts.
 
+    Args:
+        faces: YuNet output array (N, 15) in original image pixels, or None
+        w, h: Original image width and height used for normalization
+
+    Returns:
+        List of face detection results with coordinates in [0, 1]
+    """
     if faces is None:
-        return results
+        return []
 
-    for i, face in enumerate(faces):
-        x, y, bw, bh = face[0:4]
-        conf = face[14] if len(face) > 14 else face[4]  # Fallback to index 4 if shorter
+    # Normalize every box in one vectorized divide, then convert to Python floats in bulk
+    coords = (faces[:, :4] / np.array([w, h, w, h], dtype=np.float32)).tolist()
+    confs = (faces[:, 14] if faces.shape[1] > 14 else faces[:, 4]).tolist()  # Fallback to index 4 if shorter
 
-        results.append({
+    return [
+        {
             "id": f"face-{i}",
-            "x": float(x / w),
-            "y": float(y / h),
-            "width": float(bw / w),
-            "height": float(bh / h),
-            "confidence": float(conf),
+            "x": x,
+            "y": y,
+            "width": bw,
+            "height": bh,
+            "confidence": conf,
             "label": "face"
-        })
+        }
+        for i, ((x, y, bw, bh), conf) in enumerate(zip(coords, confs))
+    ]
 
-    return results
+
+def detect_faces(image_np):
+    h, w, _ = image_np.shape
+
+    faces = _run_yunet(image_np)
+
+    return _face_detections(faces, w, h)
 
 
 def grayscale_background_with_faces(image_np):
@@ -82,7 +281,7 @@ def grayscale_background_with_faces(image_np):
     Apply grayscale to background while keeping detected faces in color.
 
     Args:
-        image_np: Original color image as numpy array (H, W, 3)
+        image_np: Original color image as numpy array (H, W, 3) in BGR format
 
     Returns:
         processed_image: Image with grayscale background and colored faces
@@ -90,23 +289,17 @@ def grayscale_background_with_faces(image_np):
     """
     # Detect faces first
     h, w, _ = image_np.shape
-    yunet.setInputSize((w, h))
-    _, faces = yunet.detect(image_np)
+    faces = _run_yunet(image_np)
 
     # Create grayscale version of entire image
-    gray_image = cv2.cvtColor(image_np, cv2.COLOR_RGB2GRAY)
-    # Convert back to 3 channels so we can blend with color
-    gray_image_3ch = cv2.cvtColor(gray_image, cv2.COLOR_GRAY2RGB)
+    gray_image = cv2.cvtColor(image_np, cv2.COLOR_BGR2GRAY)
 
-    # Start with fully grayscale image
-    processed_image = gray_image_3ch.copy()
-
-    # Prepare detection results
-    detections = []
+    # Mask of pixels to keep in color (True inside any face box)
+    face_mask = np.zeros((h, w), dtype=bool)
 
     if faces is not None:
-        for i, face in enumerate(faces):
-            x, y, bw, bh, conf = face[:5]
+        for face in faces:
+            x, y, bw, bh = face[:4]
 
             # Convert to integer pixel coordinates
             x_int = int(x)
@@ -120,20 +313,15 @@ def grayscale_background_with_faces(image_np):
             x_end = min(w, x_int + w_int)
             y_end = min(h, y_int + h_int)
 
-            # Copy the original color pixels back for the face region
+            # Mark the face region; pixels are copied in a single pass below
             if x_end > x_int and y_end > y_int:
-                processed_image[y_int:y_end, x_int:x_end] = image_np[y_int:y_end, x_int:x_end]
-
-            # Store normalized detection results
-            detections.append({
-                "id": f"face-{i}",
-                "x": float(x / w),
-                "y": float(y / h),
-                "width": float(bw / w),
-                "height": float(bh / h),
-                "confidence": float(conf),
-                "label": "face"
-            })
+                face_mask[y_int:y_end, x_int:x_end] = True
+
+    # Color inside face boxes, grayscale everywhere else
+    processed_image = np.where(face_mask[..., None], image_np, gray_image[..., None])
+
+    # Store normalized detection results
+    detections = _face_detections(faces, w, h)
 
     return processed_image, detections
 
@@ -145,65 +333,76 @@ def grayscale_background_with_person(image_np, mode):
     YuNet -> detects faces, used for stats.
 
     Args:
-        image_np: Original color image as numpy array (H, W, 3) in RGB format
+        image_np: Original color image as numpy array (H, W, 3) in BGR format
+        mode: "grayscale" or "blur" background effect
 
     Returns:
-        processed_image: Image with grayscale background and colored person
+        processed_image: Image with grayscale background and colored person. This is a
+            per-thread scratch buffer, valid until the next call on the same thread
         detections: List containing person segmentation info and face detections
     """
     h, w, _ = image_np.shape
 
-    # Convert numpy array to MediaPipe Image format
-    mp_image = mp.Image(image_format=mp.ImageFormat.SRGB, data=image_np)
+    # Convert numpy array to MediaPipe Image format (MediaPipe expects RGB, YuNet uses BGR as-is)
+    rgb_image = cv2.cvtColor(image_np, cv2.COLOR_BGR2RGB, dst=_scratch("rgb", image_np.shape))
+    mp_image = mp.Image(image_format=mp.ImageFormat.SRGB, data=rgb_image)
 
-    # Segment the image
-    segmentation_result = segmenter.segment(mp_image)
+    # Detect faces using YuNet in the background while this thread runs segmentation
+    faces_future = detection_executor.submit(_run_yunet, image_np)
 
-    # Get the category mask (0 = background, 1 = person)
-    category_mask = segmentation_result.category_mask.numpy_view()
+    # Segment the image
+    with segmenter_lock:
+        segmentation_result = segmenter.segment(mp_image)
 
-    # Create binary mask (1 for person, 0 for background)
+    # Get the category mask (selfie segmenter: 0 = person, non-zero = background)
     # Squeeze to remove any extra dimensions
-    binary_mask = (category_mask > 0).astype(np.uint8).squeeze()
-
-    # # Create 3-channel mask for broadcasting
-    # mask_3ch = np.stack([binary_mask] * 3, axis=-1)
-    # Reduced kernel size from (21, 21) to (15, 15) for faster processing
-    soft_mask = cv2.GaussianBlur(
-        binary_mask.astype(np.float32),
-        (15, 15),
-        0
-    )
-
-    soft_mask = 1.0 - soft_mask
-
-    soft_mask_3ch = np.stack([soft_mask] * 3, axis=-1)
-
-    if mode == "grayscale":
-        # Create grayscale version of entire image
-        gray_image = cv2.cvtColor(image_np, cv2.COLOR_RGB2GRAY)
-        gray_image_3ch = cv2.cvtColor(gray_image, cv2.COLOR_GRAY2RGB)
+    category_mask = np.squeeze(segmentation_result.category_mask.numpy_view())
+    mask_shape = category_mask.shape
 
-        # Blend: where mask=1 (person), use original color; where mask=0 (background), use grayscale
-        processed_image = (
-            soft_mask_3ch * image_np +
-            (1 - soft_mask_3ch) * gray_image_3ch
-        ).astype(np.uint8)
-    else:
-        # Reduced kernel size from (31, 31) to (21, 21) for faster blur
-        blurred_image = cv2.GaussianBlur(image_np, (21, 21), 0)
-
-        # Blend: person stays color, background blurred
-        processed_image = (
-            soft_mask_3ch * image_np +
-            (1 - soft_mask_3ch) * blurred_image
-        ).astype(np.uint8)
+    # Create binary mask (True for background, False for person)
+    binary_mask = np.not_equal(category_mask, 0, out=_scratch("binary_mask", mask_shape, bool))
 
     # Calculate confidence as percentage of frame containing person
-    background_pixels = np.sum(binary_mask)
+    background_pixels = int(binary_mask.sum())
     total_pixels = binary_mask.size
     person_coverage = 1 - float(background_pixels / total_pixels)
 
+    if background_pixels == 0:
+        # Whole frame is person: output is the original, no background or blend needed
+        processed_image = image_np
+    else:
+        background = _scratch("background", image_np.shape)
+        if mode == "grayscale":
+            # Create grayscale version of entire image
+            gray_image = to_grayscale(image_np)
+            # blendLinear needs matching channel counts; a uint8 expansion is far cheaper than float temporaries
+            cv2.cvtColor(gray_image, cv2.COLOR_GRAY2BGR, dst=background)
+        else:
+            # Reduced kernel size from (31, 31) to (21, 21) for faster blur
+            cv2.GaussianBlur(image_np, (21, 21), 0, dst=background)
+
+        if background_pixels == total_pixels:
+            # No person in frame (e.g. idle webcam): output is just the background
+            processed_image = background
+        else:
+            # Reduced kernel size from (21, 21) to (15, 15) for faster processing
+            # Feathered background weight (1 = background, 0 = person) and its complement
+            mask_float = _scratch("mask_float", mask_shape, np.float32)
+            np.copyto(mask_float, binary_mask)
+            background_weight = cv2.GaussianBlur(
+                mask_float,
+                (15, 15),
+                0,
+                dst=_scratch("background_weight", mask_shape, np.float32)
+            )
+            person_weight = np.subtract(1.0, background_weight, out=_scratch("person_weight", mask_shape, np.float32))
+
+            # Blend in one fused pass: person stays color, background grayscale/blurred
+            processed_image = cv2.blendLinear(
+                image_np, background, person_weight, background_weight,
+                dst=_scratch("processed", image_np.shape)
+            )
+
     # Initialize detections list
     detections = []
 
@@ -215,25 +414,10 @@ def grayscale_background_with_person(image_np, mode):
             "label": "person"
         })
 
-    # Detect faces using YuNet
-    yunet.setInputSize((w, h))
-    _, faces = yunet.detect(image_np)
+    # Collect the face detections started alongside segmentation
+    faces = faces_future.result()
 
     # Add face detections
-    if faces is not None:
-        for i, face in enumerate(faces):
-
-            x, y, bw, bh = face[0:4]
-            conf = face[14] if len(face) > 14 else face[4]  # Fallback to index 4 if shorter
-
-            detections.append({
-                "id": f"face-{i}",
-                "x": float(x / w),
-                "y": float(y / h),
-                "width": float(bw / w),
-                "height": float(bh / h),
-                "confidence": float(conf),
-                "label": "face"
-            })
+    detections.extend(_face_detections(faces, w, h))
 
     return processed_image, detections
\ No newline at end of file
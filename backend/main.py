@@ -1,19 +1,39 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 from flask_cors import CORS
+from werkzeug.exceptions import HTTPException, RequestEntityTooLarge
+from waitress import serve
 from dotenv import load_dotenv
 import logging
+import base64
+import orjson
 from helpers import *
-from PIL import Image
 
 app = Flask(__name__)
 cors = CORS(app)
 
+# Upper bound on a single request body; uploads beyond this are rejected with 413 before parsing
+app.config["MAX_CONTENT_LENGTH"] = 32 * 1024 * 1024
+
+# Most frames accepted by /process-frames-batch in one request; every frame is decoded up front
+MAX_BATCH_FRAMES = 16
+
 load_dotenv()
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Real-time preview frames: lower quality, explicit 4:2:0 chroma subsampling,
+# and no progressive/optimize passes keeps encoding cheap and payloads small
+JPEG_ENCODE_PARAMS = [
+    int(cv2.IMWRITE_JPEG_QUALITY), 60,
+    int(cv2.IMWRITE_JPEG_PROGRESSIVE), 0,
+    int(cv2.IMWRITE_JPEG_OPTIMIZE), 0,
+]
+# The sampling factor flag only exists in newer OpenCV builds; older ones already default to 4:2:0
+if hasattr(cv2, "IMWRITE_JPEG_SAMPLING_FACTOR"):
+    JPEG_ENCODE_PARAMS += [int(cv2.IMWRITE_JPEG_SAMPLING_FACTOR), int(cv2.IMWRITE_JPEG_SAMPLING_FACTOR_420)]
+
 @app.route("/hello-world", methods=["GET"])
 def hello_world():
     try:
@@ -23,13 +43,56 @@ def hello_world():
         return jsonify({"error": str(e)}), 500
 
 
+@app.errorhandler(RequestEntityTooLarge)
+def request_too_large(e):
+    # Keep the JSON error shape of the other routes for bodies over MAX_CONTENT_LENGTH
+    return jsonify({"error": "Request body too large"}), 413
+
+
+def orjson_response(payload):
+    """
+    Serialize a JSON payload with orjson. Frame responses are dominated by the
+    base64 image string, which orjson encodes much faster than stdlib json.
+    """
+    return Response(orjson.dumps(payload), mimetype="application/json")
+
+
+def process_frame(image_np, mode):
+    """
+    Run the person segmentation pipeline on one decoded frame and encode the result.
+
+    Args:
+        image_np: Decoded frame as numpy array (H, W, 3) in BGR format
+        mode: "grayscale" or "blur" background effect
+
+    Returns:
+        Dict with detections and the processed frame as a base64 JPEG data URL
+    """
+    # Process: grayscale or blur background, keep entire person/body in color.
+    # The helper converts to grayscale lazily, only when the frame actually has background
+    processed_image, detections = grayscale_background_with_person(image_np, mode)
+
+    # Encode as JPEG and convert to base64 for sending to frontend
+    ok, encoded = cv2.imencode(".jpg", processed_image, JPEG_ENCODE_PARAMS)
+    if not ok:
+        raise RuntimeError("Failed to encode processed frame as JPEG")
+
+    processed_base64 = base64.b64encode(encoded.tobytes()).decode('ascii')
+
+    return {
+        "detections": detections,
+        "processed_image": f"data:image/jpeg;base64,{processed_base64}"
+    }
+
+
 @app.route("/detect-faces", methods=["POST"])
 def detect_faces_api():
     if "image" not in request.files:
         return jsonify({"error": "No image provided"}), 400
 
-    image = Image.open(request.files["image"]).convert("RGB")
-    image_np = np.array(image)
+    image_np = decode_image(request.files["image"].read())
+    if image_np is None:
+        return jsonify({"error": "Invalid image"}), 400
 
     detections = detect_faces(image_np)
     return jsonify(detections)
@@ -53,37 +116,60 @@ def process_frame_api():
         # Get mode from form data (not files)
         mode = request.form.get("mode", "grayscale")
 
-        # Read the uploaded image
-        image = Image.open(request.files["image"]).convert("RGB")
-        image_np = np.array(image)
+        # Read the uploaded image (decoded straight to BGR)
+        image_np = decode_image(request.files["image"].read())
+        if image_np is None:
+            return jsonify({"error": "Invalid image"}), 400
+
+        return orjson_response(process_frame(image_np, mode))
+
+    except HTTPException:
+        # Let Flask's own HTTP errors (e.g. 413 from MAX_CONTENT_LENGTH) keep their status
+        raise
+    except Exception as e:
+        logger.error(f"Error processing frame: {e}")
+        return jsonify({"error": str(e)}), 500
 
-        # Process: grayscale or blur background, keep entire person/body in color
-        processed_image, detections = grayscale_background_with_person(image_np, mode)
 
-        # Convert processed image back to PIL Image
-        processed_pil = Image.fromarray(processed_image)
+@app.route("/process-frames-batch", methods=["POST"])
+def process_frames_batch_api():
+    """
+    Process several video frames in one request, amortizing HTTP and Flask
+    overhead across the batch. Each frame goes through the same pipeline as
+    /process-frame.
 
-        # Encode as JPEG and convert to base64 for sending to frontend
-        import io
-        import base64
+    Returns:
+        JSON array with one entry per uploaded frame, in upload order, each with:
+        - detections: Array of face detection results
+        - processed_image: Base64 encoded image with grayscale background
+    """
+    try:
+        files = request.files.getlist("images")
+        if not files:
+            return jsonify({"error": "No images provided"}), 400
+        if len(files) > MAX_BATCH_FRAMES:
+            return jsonify({"error": f"Too many images: at most {MAX_BATCH_FRAMES} per batch"}), 413
 
-        buffer = io.BytesIO()
-        # Reduced quality from 75 to 60 for faster encoding
-        processed_pil.save(buffer, format="JPEG", quality=70, optimize=False)
-        buffer.seek(0)
+        # Get mode from form data (not files); applies to every frame in the batch
+        mode = request.form.get("mode", "grayscale")
 
-        processed_base64 = base64.b64encode(buffer.read()).decode('utf-8')
+        # Decode every frame up front so a bad upload fails the batch before any processing
+        frames = [decode_image(f.read()) for f in files]
+        for i, frame in enumerate(frames):
+            if frame is None:
+                return jsonify({"error": f"Invalid image at index {i}"}), 400
 
-        return jsonify({
-            "detections": detections,
-            "processed_image": f"data:image/jpeg;base64,{processed_base64}"
-        })
+        return orjson_response([process_frame(frame, mode) for frame in frames])
 
+    except HTTPException:
+        # Let Flask's own HTTP errors (e.g. 413 from MAX_CONTENT_LENGTH) keep their status
+        raise
     except Exception as e:
-        logger.error(f"Error processing frame: {e}")
+        logger.error(f"Error processing frame batch: {e}")
         return jsonify({"error": str(e)}), 500
 
 
-
 if __name__ == "__main__":
-    app.run(host='0.0.0.0', port=8080, debug=True, use_reloader=False)
+    # Multi-threaded production WSGI server: the native OpenCV/MediaPipe work of
+    # concurrent requests overlaps while sharing a single loaded model set
+    serve(app, host='0.0.0.0', port=8080, threads=8)